@@ -9,8 +9,14 @@ import socket
 import time
 import fcntl
 import sys
-import xml.etree.ElementTree as ET
 import tempfile
+
+# prefer the faster lxml parser if it is installed
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
 from authz_util import private_key_gen, public_keyset_from_keys
 from test_util import random_alphanum_string
 
@@ -726,6 +732,7 @@ knob_min_trace_severity=5
     # Consider using ScopedTraceChecker to simplify timestamp management
     # Caveat: the checker assumes the traces to be in XML and to have .xml file extensions,
     # which prevents fdbmonitor.log from being considered and parsed.
+    # Traces are parsed with lxml if it is installed, and with xml.etree.ElementTree otherwise.
     def add_trace_check(self, check_func, filename_substr: str = ""):
         self.trace_check_entries.append((check_func, None, None, filename_substr))
 
@@ -745,19 +752,22 @@ knob_min_trace_severity=5
         for file in glob.glob(glob_pattern):
             if filename_substr and file.find(filename_substr) == -1:
                 continue
-            for line in open(file):
-                try:
-                    entry = ET.fromstring(line)
-                    # Below fields always exist. If not, their access throws to be skipped over
-                    ev_type = entry.attrib["Type"]
-                    ts = float(entry.attrib["Time"])
-                    if time_begin != None and ts < time_begin:
-                        continue
-                    if time_end != None and time_end < ts:
-                        break  # no need to look further in this file
-                    yield (file, ev_type, entry)
-                except ET.ParseError:
-                    pass  # ignore header, footer, or broken line
+            # read as bytes, which both ElementTree and lxml parse regardless of the encoding declaration
+            with open(file, "rb") as f:
+                for line in f:
+                    try:
+                        entry = ET.fromstring(line)
+                        # Below fields always exist. If not, their access throws to be skipped over
+                        attr = entry.attrib
+                        ev_type = attr["Type"]
+                        ts = float(attr["Time"])
+                        if time_begin != None and ts < time_begin:
+                            continue
+                        if time_end != None and time_end < ts:
+                            break  # no need to look further in this file
+                        yield (file, ev_type, entry)
+                    except ET.ParseError:
+                        pass  # ignore header, footer, or broken line
 
     # applies user-provided check_func that takes a trace entry generator as the parameter
     def check_trace(self):
@@ -26,11 +26,13 @@ import admin_server
 import base64
 import glob
 import time
-import ipaddress
 import random
+import socket
+import struct
 from local_cluster import TLSConfig
 from tmp_cluster import TempCluster
-from typing import Union
+from dataclasses import dataclass
+from typing import Optional, Union
 from util import random_alphanum_str, random_alphanum_bytes, to_str, to_bytes
 import xml.etree.ElementTree as ET
 
@@ -38,6 +40,130 @@ fdb.api_version(fdb.LATEST_API_VERSION)
 
 cluster_scope = "module"
 
+_KEYSET_APPLY_EV_TYPE = "AuthzPublicKeySetApply"
+_BAD_KEYSET_EV_TYPE = "AuthzPublicKeyFileNotSet"
+_CONN_EV_TYPE = "IncomingConnection"
+_TRUSTED_CONN = 1  # admin connections
+_UNTRUSTED_CONN = 2
+# IncomingConnection's Trusted field value to the kind of connection it traces
+_CONN_TRUST_BITS = {"1": _TRUSTED_CONN, "0": _UNTRUSTED_CONN}
+# traced by flow/Trace.cpp as this prefix followed by the offending event type, so the set of
+# such event types is unbounded and they are matched by prefix
+_INVALID_AUDIT_LOG_EV_PREFIX = "InvalidAuditLogType_"
+_INVALID_AUDIT_LOG_EV_PREFIX_LEN = len(_INVALID_AUDIT_LOG_EV_PREFIX)
+
+
+# results accumulated by the authorization trace check handlers below over a single pass of the traces
+@dataclass
+class _AuthzTraceState:
+    apply_trace_time: Optional[float] = None
+    bad_trace_time: Optional[float] = None
+    conns_traced: int = 0  # bitmask of _TRUSTED_CONN and _UNTRUSTED_CONN
+
+
+# handlers return True once their check is settled, after which they are no longer dispatched to
+def _on_keyset_apply(filename, entry, state):
+    attr = entry.attrib
+    if int(attr["NumPublicKeys"]) > 0:
+        state.apply_trace_time = float(attr["Time"])
+        return True
+    return False
+
+
+def _on_bad_keyset(filename, entry, state):
+    state.bad_trace_time = float(entry.attrib["Time"])
+    return True
+
+
+def _on_connection(filename, entry, state):
+    attr = entry.attrib
+    trusted = attr["Trusted"]
+    from_addr = attr["FromAddr"]
+    # split from the right so that IPv6 addresses, formatted as '[addr]:port:tls', stay intact
+    parts = from_addr.rsplit(":", 2)
+    if len(parts) != 3:
+        pytest.fail(
+            f"{_CONN_EV_TYPE} trace entry's FromAddr is not in 'ip:port:tls' format: found '{from_addr}'"
+        )
+    client_ip, port, tls_suffix = parts
+    if tls_suffix != "tls":
+        pytest.fail(
+            f"{_CONN_EV_TYPE} trace entry's FromAddr does not have a valid ':tls' suffix: found '{tls_suffix}'"
+        )
+    # IPv6 addresses are always bracketed, IPv4 addresses never are
+    family = socket.AF_INET
+    if client_ip.startswith("[") and client_ip.endswith("]"):
+        family = socket.AF_INET6
+        client_ip = client_ip[1:-1]
+    try:
+        socket.inet_pton(family, client_ip)
+    except OSError as e:
+        pytest.fail(
+            f"{_CONN_EV_TYPE} trace entry's FromAddr '{client_ip}' has an invalid IP format: {e}"
+        )
+
+    bit = _CONN_TRUST_BITS.get(trusted, 0)
+    if not bit:
+        pytest.fail(
+            f"{_CONN_EV_TYPE} trace entry's Trusted field has an unexpected value: {trusted}"
+        )
+    state.conns_traced |= bit
+    # every connection entry's format is checked, so this handler never settles early
+    return False
+
+
+_AUTHZ_TRACE_HANDLERS = {
+    _KEYSET_APPLY_EV_TYPE: _on_keyset_apply,
+    _BAD_KEYSET_EV_TYPE: _on_bad_keyset,
+    _CONN_EV_TYPE: _on_connection,
+}
+
+
+# runs all authorization trace checks in a single pass, dispatching each entry on its event type
+def _check_authz_traces(entries, cluster_creation_time, look_for_untrusted):
+    state = _AuthzTraceState()
+    handlers = dict(_AUTHZ_TRACE_HANDLERS)
+    for filename, ev_type, entry in entries:
+        if ev_type[:_INVALID_AUDIT_LOG_EV_PREFIX_LEN] == _INVALID_AUDIT_LOG_EV_PREFIX:
+            pytest.fail(
+                "Invalid audit log detected in file {}: {}".format(
+                    filename, entry.items()
+                )
+            )
+        h = handlers.get(ev_type)
+        if h is not None and h(filename, entry, state):
+            del handlers[ev_type]
+
+    if state.apply_trace_time is None:
+        pytest.fail(
+            f"failed to find '{_KEYSET_APPLY_EV_TYPE}' event with >0 public keys"
+        )
+    else:
+        print(
+            f"'{_KEYSET_APPLY_EV_TYPE}' found at {state.apply_trace_time - cluster_creation_time}s since cluster creation"
+        )
+    if state.bad_trace_time is not None:
+        pytest.fail(
+            f"unexpected '{_BAD_KEYSET_EV_TYPE}' trace found at {state.bad_trace_time}"
+        )
+    if look_for_untrusted and not state.conns_traced & _UNTRUSTED_CONN:
+        pytest.fail(
+            "failed to find any 'IncomingConnection' traces for untrusted clients"
+        )
+    if not state.conns_traced & _TRUSTED_CONN:
+        pytest.fail(
+            "failed to find any 'IncomingConnection' traces for trusted clients"
+        )
+
+
+# claim fields that are the same for every token minted by token_claim_1h
+_TOKEN_CLAIM_TEMPLATE = {
+    "iss": "fdb-authz-tester",
+    "sub": "authz-test",
+}
+# tenant IDs are encoded in token claims as base64 of their 8-byte big-endian representation
+_pack_tenant_id = struct.Struct(">Q").pack
+
 
 def pytest_addoption(parser):
     parser.addoption(
@@ -152,6 +278,7 @@ def cluster(
         certfile = str(cluster.client_cert_file)
         cafile = str(cluster.server_ca_file)
         logdir = str(cluster.log)
+        cluster.cluster_file_str = str(cluster.cluster_file)
         fdb.options.set_tls_key_path(keyfile if trusted_client else "")
         fdb.options.set_tls_cert_path(certfile if trusted_client else "")
         fdb.options.set_tls_ca_path(cafile)
@@ -163,121 +290,67 @@ def cluster(
             "configure_client", [force_multi_version_client, use_grv_cache, logdir]
         )
         admin_ipc.request("configure_tls", [keyfile, certfile, cafile])
-        admin_ipc.request("connect", [str(cluster.cluster_file)])
-
-        def check_no_invalid_traces(entries):
-            for filename, ev_type, entry in entries:
-                if ev_type.startswith("InvalidAuditLogType_"):
-                    pytest.fail(
-                        "Invalid audit log detected in file {}: {}".format(
-                            filename, entry.items()
-                        )
-                    )
-
-        cluster.add_trace_check(check_no_invalid_traces)
-
-        def check_public_keyset_apply(entries, cluster_creation_time):
-            keyset_apply_ev_type = "AuthzPublicKeySetApply"
-            bad_ev_type = "AuthzPublicKeyFileNotSet"
-            apply_trace_time = None
-            bad_trace_time = None
-            for filename, ev_type, entry in entries:
-                if (
-                    apply_trace_time is None
-                    and ev_type == keyset_apply_ev_type
-                    and int(entry.attrib["NumPublicKeys"]) > 0
-                ):
-                    apply_trace_time = float(entry.attrib["Time"])
-                if bad_trace_time is None and ev_type == bad_ev_type:
-                    bad_trace_time = float(entry.attrib["Time"])
-            if apply_trace_time is None:
-                pytest.fail(
-                    f"failed to find '{keyset_apply_ev_type}' event with >0 public keys"
-                )
-            else:
-                print(
-                    f"'{keyset_apply_ev_type}' found at {apply_trace_time - cluster_creation_time}s since cluster creation"
-                )
-            if bad_trace_time is not None:
-                pytest.fail(
-                    f"unexpected '{bad_ev_type}' trace found at {bad_trace_time}"
-                )
-
-        cluster.add_trace_check(
-            functools.partial(
-                check_public_keyset_apply, cluster_creation_time=cluster_creation_time
-            )
-        )
-
-        def check_connection_traces(entries, look_for_untrusted):
-            trusted_conns_traced = False  # admin connections
-            untrusted_conns_traced = False
-            ev_target = "IncomingConnection"
-            for _, ev_type, entry in entries:
-                if ev_type == ev_target:
-                    trusted = entry.attrib["Trusted"]
-                    from_addr = entry.attrib["FromAddr"]
-                    client_ip, port, tls_suffix = from_addr.split(":")
-                    if tls_suffix != "tls":
-                        pytest.fail(
-                            f"{ev_target} trace entry's FromAddr does not have a valid ':tls' suffix: found '{tls_suffix}'"
-                        )
-                    try:
-                        ipaddress.ip_address(client_ip)
-                    except ValueError as e:
-                        pytest.fail(
-                            f"{ev_target} trace entry's FromAddr '{client_ip}' has an invalid IP format: {e}"
-                        )
-
-                    if trusted == "1":
-                        trusted_conns_traced = True
-                    elif trusted == "0":
-                        untrusted_conns_traced = True
-                    else:
-                        pytest.fail(
-                            f"{ev_target} trace entry's Trusted field has an unexpected value: {trusted}"
-                        )
-            if look_for_untrusted and not untrusted_conns_traced:
-                pytest.fail(
-                    "failed to find any 'IncomingConnection' traces for untrusted clients"
-                )
-            if not trusted_conns_traced:
-                pytest.fail(
-                    "failed to find any 'IncomingConnection' traces for trusted clients"
-                )
+        admin_ipc.request("connect", [cluster.cluster_file_str])
 
         cluster.add_trace_check(
             functools.partial(
-                check_connection_traces, look_for_untrusted=not trusted_client
+                _check_authz_traces,
+                cluster_creation_time=cluster_creation_time,
+                look_for_untrusted=not trusted_client,
             )
         )
 
         yield cluster
 
 
-@pytest.fixture
-def db(cluster, admin_ipc):
-    db = fdb.open(str(cluster.cluster_file))
+# database handle is opened once per cluster and shared by all of its tests,
+# while the database contents are still cleaned up after every test by the db fixture.
+# it cannot be session-scoped, as it depends on the cluster fixture.
+@pytest.fixture(scope=cluster_scope)
+def _db_handle(cluster):
+    db = fdb.open(cluster.cluster_file_str)
     db.options.set_transaction_retry_limit(10)
     yield db
-    admin_ipc.request("cleanup_database")
     db = None
 
 
 @pytest.fixture
-def tenant_gen(db, admin_ipc):
+def db(_db_handle, admin_ipc):
+    yield _db_handle
+    admin_ipc.request("cleanup_database")
+
+
+# admin server's create_tenant/delete_tenant take any number of tenants,
+# so the plural fixtures create or delete a whole batch in one IPC round-trip
+@pytest.fixture
+def tenants_gen(db, admin_ipc):
+    def fn(tenants):
+        admin_ipc.request("create_tenant", [to_bytes(tenant) for tenant in tenants])
+
+    return fn
+
+
+@pytest.fixture
+def tenants_del(db, admin_ipc, tenant_id_from_name):
+    def fn(tenants):
+        admin_ipc.request("delete_tenant", [to_str(tenant) for tenant in tenants])
+        tenant_id_from_name.cache_clear()
+
+    return fn
+
+
+@pytest.fixture
+def tenant_gen(tenants_gen):
     def fn(tenant):
-        tenant = to_bytes(tenant)
-        admin_ipc.request("create_tenant", [tenant])
+        tenants_gen([tenant])
 
     return fn
 
 
 @pytest.fixture
-def tenant_del(db, admin_ipc):
+def tenant_del(tenants_del):
     def fn(tenant):
-        tenant = to_str(tenant)
-        admin_ipc.request("delete_tenant", [tenant])
+        tenants_del([tenant])
 
     return fn
 
@@ -304,10 +377,13 @@ def tenant_tr_gen(db, use_grv_cache):
 
 @pytest.fixture
 def tenant_id_from_name(db):
-    def fn(tenant_name):
+    # tenant IDs never change once the tenant is created, so lookups are cached.
+    # tenant_del clears the cache, as a re-created tenant of the same name gets a new ID.
+    @functools.lru_cache(maxsize=256)
+    def lookup(tenant_name: bytes):
         while True:
             try:
-                tenant = db.open_tenant(to_bytes(tenant_name))
+                tenant = db.open_tenant(tenant_name)
                 return tenant.get_id().wait()  # returns int
             except fdb.FDBError as e:
                 print(
@@ -317,26 +393,29 @@ def tenant_id_from_name(db):
                 )
                 time.sleep(0.5)
 
+    def fn(tenant_name: Union[bytes, str]):
+        return lookup(to_bytes(tenant_name))
+
+    fn.cache_clear = lookup.cache_clear
     return fn
 
 
 @pytest.fixture
 def token_claim_1h(tenant_id_from_name):
+    b64encode = base64.b64encode
+
     # JWT claim that is valid for 1 hour since time of invocation
     def fn(tenant_name: Union[bytes, str]):
         tenant_id = tenant_id_from_name(tenant_name)
         now = time.time()
-        return {
-            "iss": "fdb-authz-tester",
-            "sub": "authz-test",
-            "aud": ["tmp-cluster"]
-            if random.choice([True, False])
-            else "tmp-cluster",  # too expensive to parameterize just for this
-            "iat": now,
-            "nbf": now - 1,
-            "exp": now + 60 * 60,
-            "jti": random_alphanum_str(10),
-            "tenants": [to_str(base64.b64encode(tenant_id.to_bytes(8, "big")))],
-        }
+        claim = _TOKEN_CLAIM_TEMPLATE.copy()
+        # too expensive to parameterize just for this
+        claim["aud"] = ["tmp-cluster"] if random.getrandbits(1) else "tmp-cluster"
+        claim["iat"] = now
+        claim["nbf"] = now - 1
+        claim["exp"] = now + 60 * 60
+        claim["jti"] = random_alphanum_str(10)
+        claim["tenants"] = [b64encode(_pack_tenant_id(tenant_id)).decode("ascii")]
+        return claim
 
     return fn